@@ -1,23 +1,105 @@
-import json
+import glob
+import hashlib
 import os
 import re
+import numpy as np
 import pandas as pd
+import matplotlib
+matplotlib.use('Agg')
 import matplotlib.pyplot as plt
 import seaborn as sns
+from concurrent.futures import ThreadPoolExecutor
 from matplotlib.ticker import FuncFormatter
 
-def thousands_formatter(x, pos):
-    if x >= 1_000_000:
-        return f'{int(x/1_000_000)}M'
-    elif x >= 1_000:
-        return f'{int(x/1_000)}K'
-    return f'{int(x)}'
+try:
+    from orjson import loads as json_loads
+except ImportError:
+    from json import loads as json_loads
 
-def metric_formatter(value, unit=""):
-    if value == int(value):
-        return f'{int(value)}{unit}'
-    else:
-        return f'{value:.2f}{unit}'
+plt.rcParams.update({
+    'path.simplify': True,
+    'path.simplify_threshold': 1.0,
+    'agg.path.chunksize': 10000,
+    'savefig.dpi': 100,
+})
+
+# Parsed reports are cached here as Parquet, next to a key naming the reports they came from.
+# Bump CACHE_VERSION whenever the columns or labels of the cached frame change.
+CACHE_DIR = '.cache'
+CACHE_FILE = os.path.join(CACHE_DIR, '10m_reports.parquet')
+CACHE_KEY_FILE = os.path.join(CACHE_DIR, '10m_reports.key')
+CACHE_VERSION = 1
+
+# Unpacks writers, records and batch size from a report file name
+REPORT_NAME_RE = re.compile(r"run-W(\d+)-R(\d+)-B(\d+)\.json")
+
+def thousands_labels(values):
+    """Formats an array of integers as labels such as '10K' or '2M'."""
+    values = np.asarray(values)
+    return np.select(
+        [values >= 1_000_000, values >= 1_000],
+        [np.char.add((values // 1_000_000).astype(str), 'M'), np.char.add((values // 1_000).astype(str), 'K')],
+        default=values.astype(str)
+    )
+
+def metric_labels(values, unit=""):
+    """
+    Formats an array of metric values as annotations. Whole numbers are shown
+    without decimals, and missing (NaN) values are left blank.
+    """
+    values = np.asarray(values, dtype=np.float64)
+    missing = np.isnan(values)
+    values = np.where(missing, 0.0, values)
+    labels = np.where(values == np.trunc(values), values.astype(np.int64).astype(str), np.char.mod('%.2f', values))
+    return np.where(missing, '', np.char.add(labels, unit))
+
+def read_custom_metrics(filepath):
+    """Reads the custom metrics injected into a hyperfine JSON report."""
+    with open(filepath, 'rb') as f:
+        data = json_loads(f.read())
+    return data['results'][0].get('custom_metrics', {})
+
+def report_cache_key(paths):
+    """Returns the cache key for these report files, from their modification time and size."""
+    manifest = []
+    for p in paths:
+        st = os.stat(p)
+        manifest.append((p, st.st_mtime_ns, st.st_size))
+    return hashlib.sha1(repr((CACHE_VERSION, manifest)).encode()).hexdigest()
+
+def read_cached_data(cache_key):
+    """Returns the cached frame if it was built from the same reports, otherwise None."""
+    try:
+        with open(CACHE_KEY_FILE) as f:
+            if f.read() != cache_key:
+                return None
+        return pd.read_parquet(CACHE_FILE)
+    except (ImportError, OSError, ValueError): # Missing, unreadable or corrupt cache
+        return None
+
+def write_cached_data(df, cache_key):
+    """
+    Replaces the cached frame and its key. Each is written to a temporary file
+    and moved into place, so a failed write never leaves a truncated cache.
+    """
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    tmp_file = CACHE_FILE + '.tmp'
+    try:
+        df.to_parquet(tmp_file, compression='zstd')
+    except ImportError:
+        return # No Parquet engine (pyarrow) installed, so run without the cache
+    except BaseException:
+        if os.path.exists(tmp_file):
+            os.remove(tmp_file)
+        raise
+
+    # Drop the old key first, so the new frame is never matched against it
+    if os.path.exists(CACHE_KEY_FILE):
+        os.remove(CACHE_KEY_FILE)
+    os.replace(tmp_file, CACHE_FILE)
+    with open(CACHE_KEY_FILE + '.tmp', 'w') as f:
+        f.write(cache_key)
+    os.replace(CACHE_KEY_FILE + '.tmp', CACHE_KEY_FILE)
 
 def get_10m_data():
     """
@@ -28,58 +110,79 @@ def get_10m_data():
         print(f"Error: Directory not found: {data_dir}")
         return pd.DataFrame()
 
-    records = []
-    pattern = re.compile(r"run-W(\d+)-R(10000000)-B(\d+)\.json") # Filter for 10M records
-
-    for filename in os.listdir(data_dir):
-        if filename.endswith('.json'):
-            match = pattern.match(filename)
-            if match:
-                writers, total_records, batch_size = map(int, match.groups())
-                filepath = os.path.join(data_dir, filename)
-                with open(filepath, 'r') as f:
-                    data = json.load(f)
-                    result = data['results'][0]
-                    custom_metrics = result.get('custom_metrics', {})
-                    
-                    records.append({
-                        'writers': writers,
-                        'records': total_records,
-                        'batch_size': batch_size,
-                        'total_time_ms': custom_metrics.get('total_time_ms'),
-                        'record_throughput_m_sec': custom_metrics.get('record_throughput_m_sec'),
-                        'mem_throughput_gb_sec': custom_metrics.get('mem_throughput_gb_sec'),
-                    })
-
-    df = pd.DataFrame(records)
-    df['formatted_batch_size'] = df['batch_size'].apply(lambda x: thousands_formatter(x, None))
+    # Let glob filter for 10M records; the regex only unpacks the parameters
+    paths = sorted(glob.glob(os.path.join(data_dir, 'run-W*-R10000000-B*.json')))
+
+    # Reuse the previous result if none of the reports changed
+    cache_key = report_cache_key(paths)
+    cached_df = read_cached_data(cache_key)
+    if cached_df is not None:
+        return cached_df
+
+    params = {}
+    for filepath in paths:
+        match = REPORT_NAME_RE.match(os.path.basename(filepath))
+        if match:
+            params[filepath] = tuple(map(int, match.groups()))
+
+    # Reports are independent, so read them concurrently
+    with ThreadPoolExecutor() as executor:
+        all_metrics = list(executor.map(read_custom_metrics, params))
+
+    # Fill one typed array per column rather than building a list of row dicts
+    n = len(params)
+    writers = np.empty(n, dtype=np.int32)
+    records = np.empty(n, dtype=np.int64)
+    batch_size = np.empty(n, dtype=np.int64)
+    total_time_ms = np.empty(n, dtype=np.float64)
+    record_throughput_m_sec = np.empty(n, dtype=np.float64)
+    mem_throughput_gb_sec = np.empty(n, dtype=np.float64)
+
+    for i, ((w, r, b), custom_metrics) in enumerate(zip(params.values(), all_metrics)):
+        writers[i], records[i], batch_size[i] = w, r, b
+        total_time_ms[i] = custom_metrics.get('total_time_ms', np.nan)
+        record_throughput_m_sec[i] = custom_metrics.get('record_throughput_m_sec', np.nan)
+        mem_throughput_gb_sec[i] = custom_metrics.get('mem_throughput_gb_sec', np.nan)
+
+    df = pd.DataFrame({
+        'writers': writers,
+        'records': records,
+        'batch_size': batch_size,
+        'total_time_ms': total_time_ms,
+        'record_throughput_m_sec': record_throughput_m_sec,
+        'mem_throughput_gb_sec': mem_throughput_gb_sec,
+        'formatted_batch_size': thousands_labels(batch_size),
+    })
+
+    write_cached_data(df, cache_key)
     return df
 
-def plot_metric_heatmap(df, metric_col, title, filename, cmap, unit=""):
+def plot_metric_heatmap(fig, ax, cbar_ax, df, metric_col, title, filename, cmap, unit=""):
     """
     Generates a heatmap for a specific metric for 10M records.
+
+    The figure and its axes are reused across metrics, so they are cleared before drawing.
     """
     pivot_table = df.pivot_table(index='writers', columns='formatted_batch_size', values=metric_col)
     
     # Ensure column order
-    ordered_batch_sizes = [thousands_formatter(bs, None) for bs in sorted(df['batch_size'].unique())]
+    ordered_batch_sizes = thousands_labels(np.sort(df['batch_size'].unique()))
     pivot_table = pivot_table[ordered_batch_sizes]
 
-    plt.figure(figsize=(8, 6))
-    ax = sns.heatmap(pivot_table, annot=True, fmt=".2f", cmap=cmap, linewidths=.5) # Draw with default fmt
-    
-    # Manually format annotations
-    for text in ax.texts:
-        text.set_text(metric_formatter(float(text.get_text()), unit)) # Convert to float before formatting
+    # Pre-format annotations instead of rewriting the drawn text afterwards.
+    # Writer/batch size combinations without a report are left blank.
+    annot = metric_labels(pivot_table.values, unit)
+
+    ax.clear()
+    cbar_ax.clear()
+    sns.heatmap(pivot_table, annot=annot, fmt="", cmap=cmap, linewidths=.5, ax=ax, cbar_ax=cbar_ax)
 
     ax.invert_yaxis() # Invert y-axis to have increasing values upwards
 
-    plt.title(title, fontsize=14, y=1.05) # Adjusted y for title spacing
-    plt.xlabel("Record Batch Size")
-    plt.ylabel("Number of Writers")
-    plt.tight_layout()
-    plt.savefig(f"crates/parquet-nested-parallel/visualizations/{filename}")
-    plt.close()
+    ax.set_title(title, fontsize=14, y=1.05) # Adjusted y for title spacing
+    ax.set_xlabel("Record Batch Size")
+    ax.set_ylabel("Number of Writers")
+    fig.savefig(f"crates/parquet-nested-parallel/visualizations/{filename}")
     print(f"Generated {filename}")
 
 
@@ -88,8 +191,12 @@ if __name__ == "__main__":
     data_df = get_10m_data()
 
     if not data_df.empty:
+        # A single figure is shared by all heatmaps; the narrow right axes holds the colorbar
+        fig, (ax, cbar_ax) = plt.subplots(1, 2, figsize=(8, 6), gridspec_kw={'width_ratios': [20, 1]}, layout='constrained')
+
         # Heatmap for total_time_ms (lower is better, so reversed colormap)
         plot_metric_heatmap(
+            fig, ax, cbar_ax,
             data_df, 
             'total_time_ms',
             f'Wall-Clock Time for 10 Million Records', # Shortened title
@@ -100,6 +207,7 @@ if __name__ == "__main__":
 
         # Heatmap for record_throughput_m_sec (higher is better)
         plot_metric_heatmap(
+            fig, ax, cbar_ax,
             data_df, 
             'record_throughput_m_sec',
             f'Record Throughput for 10 Million Records', # Shortened title
@@ -110,6 +218,7 @@ if __name__ == "__main__":
 
         # Heatmap for mem_throughput_gb_sec (higher is better)
         plot_metric_heatmap(
+            fig, ax, cbar_ax,
             data_df, 
             'mem_throughput_gb_sec',
             f'Memory Throughput for 10 Million Records', # Shortened title
@@ -117,3 +226,5 @@ if __name__ == "__main__":
             'YlGnBu',
             unit=" GB/s"
         )
+
+        plt.close(fig)
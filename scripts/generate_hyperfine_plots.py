@@ -1,97 +1,123 @@
-import json
+import argparse
+import matplotlib
+matplotlib.use('Agg')
 import matplotlib.pyplot as plt
 import os
 import sys
-import subprocess
 import numpy as np
-
-def get_data():
-    """
-    Finds and reads all hyperfine_results.json files from the performance_results
-    directory, returning the data.
-    """
-    try:
-        # Search specifically in the performance_results directory
-        fd_output = subprocess.check_output(['fd', 'hyperfine_results.json', 'performance_results/'], text=True)
-        files = sorted(fd_output.strip().split('\n'))
-    except (subprocess.CalledProcessError, FileNotFoundError):
-        print("Error: Could not execute 'fd'. Please ensure 'fd' is installed and in your PATH.")
-        sys.exit(1)
-
-    all_times = []
-    labels = []
-    for f in files:
-        if not os.path.exists(f):
-            print(f"Warning: File not found, skipping: {f}")
-            continue
-        with open(f, 'r') as file:
-            data = json.load(file)
-            all_times.append(data['results'][0]['times'])
-            full_label = os.path.basename(os.path.dirname(f))
-            labels.append(full_label.split('-')[0])
-
-    if not all_times:
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from output_manifest import record_inputs, run_label, stale_outputs
+
+try:
+    from orjson import loads as json_loads
+except ImportError:
+    from json import loads as json_loads
+
+try:
+    import ijson
+except ImportError:
+    ijson = None
+
+plt.rcParams.update({
+    'path.simplify': True,
+    'path.simplify_threshold': 1.0,
+    'agg.path.chunksize': 10000,
+    'savefig.dpi': 100,
+})
+
+# Reports above this size are streamed with ijson so that only the `times`
+# array of the first result is built, not the whole document.
+STREAM_THRESHOLD_BYTES = 1_000_000
+
+BOXPLOT_PROPS = {
+    'boxprops': {'color':'black'},
+    'medianprops': {'color':'black'},
+    'whiskerprops': {'color':'black'},
+    'capprops': {'color':'black'}
+}
+
+def read_times(f):
+    """Reads the run times and the run label from a hyperfine_results.json file."""
+    with open(f, 'rb') as file:
+        if ijson is not None and os.path.getsize(f) > STREAM_THRESHOLD_BYTES:
+            times = next(ijson.items(file, 'results.item.times', use_float=True))
+        else:
+            times = json_loads(file.read())['results'][0]['times']
+    return times, run_label(f)
+
+def find_result_files():
+    """Finds all hyperfine_results.json files in the performance_results directory."""
+    files = sorted(str(p) for p in Path('performance_results').rglob('hyperfine_results.json'))
+    if not files:
         print("Error: No data found to plot.")
         sys.exit(1)
+    return files
 
-    return all_times, labels
-
-def create_boxplot_grid(all_times, labels):
-    """Generates a 4x3 grid of box plots."""
-    fig, axes = plt.subplots(nrows=4, ncols=3, figsize=(12, 12), sharey=False)
+def get_data(files):
+    """Reads the hyperfine_results.json files, returning the run times and labels."""
+    # Files are independent, so read them concurrently. `map` keeps the sorted order.
+    with ThreadPoolExecutor() as executor:
+        results = list(executor.map(read_times, files))
 
-    boxplot_props = {'boxprops': {'facecolor':'none', 'edgecolor':'black'}, 'medianprops': {'color':'black'}, 'whiskerprops': {'color':'black'}, 'capprops': {'color':'black'}}
+    # Convert once here, so later statistics work on arrays rather than lists
+    all_times = [np.asarray(times, dtype=float) for times, _ in results]
+    labels = [label for _, label in results]
 
-    for i, (times, label) in enumerate(zip(all_times, labels)):
-        row, col = i // 3, i % 3
-        ax = axes[row, col]
-        ax.boxplot(times, patch_artist=True, showfliers=False, **boxplot_props)
-        ax.set_title(f'Run {label}')
-        ax.set_ylabel('Time (s)')
-        ax.set_xticklabels([])
-        ax.spines['top'].set_visible(False)
-        ax.spines['right'].set_visible(False)
+    return all_times, labels
 
-    # Remove empty subplots if number of datasets is not a multiple of 3
-    for i in range(len(all_times), 12):
-        row, col = i // 3, i % 3
-        fig.delaxes(axes[row][col])
+def box_stats(times):
+    """
+    Computes the box plot statistics for one run with NumPy, for `ax.bxp`.
+    Whiskers extend to the furthest point within 1.5 IQR, as in `ax.boxplot`.
+    """
+    q1, med, q3 = np.percentile(times, [25, 50, 75])
+    iqr = q3 - q1
+    return {
+        'med': med, 'q1': q1, 'q3': q3,
+        'whislo': times[times >= q1 - 1.5 * iqr].min(),
+        'whishi': times[times <= q3 + 1.5 * iqr].max(),
+        'fliers': [],
+    }
 
-    plt.tight_layout(h_pad=3.0)
-    plt.savefig("boxplot_grid.png")
-    print("Generated boxplot_grid.png (4x3 layout)")
+def create_boxplot_grid(all_stats, labels, nrows, ncols, figsize, filename):
+    """
+    Generates a grid of box plots, one per run, from precomputed `box_stats`,
+    removing any unused subplots.
+    """
+    fig, axes = plt.subplots(nrows=nrows, ncols=ncols, figsize=figsize, sharey=False, squeeze=False, layout='constrained')
+    fig.get_layout_engine().set(h_pad=0.2) # Extra room between rows for the titles
 
-def create_boxplot_row(all_times, labels):
-    """Generates a 2x6 grid of box plots."""
-    fig, axes = plt.subplots(nrows=2, ncols=6, figsize=(20, 7), sharey=False)
+    for ax, stats, label in zip(axes.flat, all_stats, labels):
+        ax.bxp([stats], showfliers=False, **BOXPLOT_PROPS)
 
-    boxplot_props = {'boxprops': {'facecolor':'none', 'edgecolor':'black'}, 'medianprops': {'color':'black'}, 'whiskerprops': {'color':'black'}, 'capprops': {'color':'black'}}
+        plot_title = f'Run {label}'
+        if label == '00':
+            plot_title += ' (baseline)'
+        ax.set_title(plot_title)
 
-    for i, (times, label) in enumerate(zip(all_times, labels)):
-        row, col = i // 6, i % 6
-        ax = axes[row, col]
-        ax.boxplot(times, patch_artist=True, showfliers=False, **boxplot_props)
-        ax.set_title(f'Run {label}')
         ax.set_ylabel('Time (s)')
         ax.set_xticklabels([])
         ax.spines['top'].set_visible(False)
         ax.spines['right'].set_visible(False)
 
-    for i in range(len(all_times), 12):
-        row, col = i // 6, i % 6
-        fig.delaxes(axes[row][col])
+    # Remove empty subplots if the number of runs does not fill the grid
+    for ax in axes.flat[len(all_stats):]:
+        fig.delaxes(ax)
 
-    plt.tight_layout(h_pad=3.0)
-    plt.savefig("boxplot_row.png")
-    print("Generated boxplot_row.png")
+    plt.savefig(filename)
+    plt.close()
+    print(f"Generated {filename} ({nrows}x{ncols} layout)")
 
 def create_trend_plot(all_times, labels):
     """Generates a line plot showing the trend of median times."""
-    medians = [np.median(times) for times in all_times]
-    mins = [min(times) for times in all_times]
-    maxs = [max(times) for times in all_times]
+    # Runs of equal length stack into one 2D array, reduced in a single call
+    if len({len(times) for times in all_times}) == 1:
+        mins, medians, maxs = np.quantile(np.stack(all_times), [0, 0.5, 1], axis=1)
+    else:
+        mins, medians, maxs = np.array([np.quantile(times, [0, 0.5, 1]) for times in all_times]).T
     
-    plt.figure(figsize=(12, 7))
+    plt.figure(figsize=(12, 7), layout='constrained')
     ax = plt.gca()
 
     # Plot the median line
@@ -108,85 +134,75 @@ def create_trend_plot(all_times, labels):
     ax.spines['top'].set_visible(False)
     ax.spines['right'].set_visible(False)
     
-    plt.tight_layout()
     plt.savefig("trend_plot.png")
+    plt.close()
     print("Generated trend_plot.png")
 
-def create_custom_boxplot_grid(all_times, labels, filename, title):
-    """Generates a custom box plot grid."""
-    ncols = 3
-    nrows = (len(all_times) + ncols - 1) // ncols
-    fig, axes = plt.subplots(nrows=nrows, ncols=ncols, figsize=(12, 4 * nrows), sharey=False, squeeze=False)
 
-    boxplot_props = {'boxprops': {'facecolor':'none', 'edgecolor':'black'}, 'medianprops': {'color':'black'}, 'whiskerprops': {'color':'black'}, 'capprops': {'color':'black'}}
-
-    axes = axes.flatten()
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Plots the hyperfine results found under performance_results/.")
+    parser.add_argument('--force', action='store_true', help="regenerate every plot, even if its inputs are unchanged")
+    args = parser.parse_args()
 
-    for i, (times, label) in enumerate(zip(all_times, labels)):
-        ax = axes[i]
-        ax.boxplot(times, patch_artist=True, showfliers=False, **boxplot_props)
-        
-        plot_title = f'Run {label}'
-        if label == '00':
-            plot_title += ' (baseline)'
-        ax.set_title(plot_title)
-        
-        ax.set_ylabel('Time (s)')
-        ax.set_xticklabels([])
-        ax.spines['top'].set_visible(False)
-        ax.spines['right'].set_visible(False)
+    files = find_result_files()
+    int_labels = np.array([int(run_label(f)) for f in files])
 
-    # Remove empty subplots
-    for i in range(len(all_times), len(axes)):
-        fig.delaxes(axes[i])
+    batches = {
+        "phase1": [1, 2, 3, 4, 5],
+        "phase2": [5, 6, 7, 8, 9],
+        "phase3": [9, 10, 11],
+        "phase4": [11, 12, 13]
+    }
+    batch_indices = {name: np.flatnonzero(np.isin(int_labels, run_numbers)) for name, run_numbers in batches.items()}
 
-    plt.tight_layout(h_pad=3.0)
-    plt.savefig(filename)
-    print(f"Generated {filename}")
+    # Each plot, with the result files it is drawn from
+    plot_files = {"trend_plot.png": files}
+    if len(files) > 1:
+        plot_files["boxplot_grid.png"] = plot_files["boxplot_row.png"] = files[1:]
+    for name, indices in batch_indices.items():
+        if len(indices):
+            plot_files[f"boxplot_grid_{name}.png"] = [files[i] for i in indices]
+    stale_plots, manifests = stale_outputs(plot_files, __file__, args.force)
 
+    if not stale_plots:
+        print("All hyperfine plots are up to date.")
+        sys.exit(0)
 
-if __name__ == "__main__":
-    all_times, labels = get_data()
+    all_times, labels = get_data(files)
 
     # Trend plot includes the baseline (0th) measurement, labeled as '00'
     # The '01' directory is the baseline.
-    trend_labels = [f"{int(l) - 1:02d}" for l in labels]
-    create_trend_plot(all_times, trend_labels)
+    trend_labels = [f"{l - 1:02d}" for l in int_labels]
+    if "trend_plot.png" in stale_plots:
+        create_trend_plot(all_times, trend_labels)
+
+    # Every layout below draws the same runs, so compute their statistics once
+    all_stats = [box_stats(times) for times in all_times]
 
     # Box plots exclude the baseline measurement.
     # The run labeled '01' corresponds to data from the '02' directory.
     if len(all_times) > 1:
-        boxplot_times = all_times[1:]
-        boxplot_labels = [f"{int(l) - 1:02d}" for l in labels[1:]]
-        create_boxplot_grid(boxplot_times, boxplot_labels)
-        create_boxplot_row(boxplot_times, boxplot_labels)
+        boxplot_stats = all_stats[1:]
+        boxplot_labels = trend_labels[1:]
+        if "boxplot_grid.png" in stale_plots:
+            create_boxplot_grid(boxplot_stats, boxplot_labels, 4, 3, (12, 12), "boxplot_grid.png")
+        if "boxplot_row.png" in stale_plots:
+            create_boxplot_grid(boxplot_stats, boxplot_labels, 2, 6, (20, 7), "boxplot_row.png")
     else:
         print("Skipping box plots: not enough data points for comparison after excluding baseline.")
 
     # --- Batched Box Plots ---
     print("\nGenerating batched box plots...")
-    
-    # Create a mapping from the run number (as integer) to its index in the lists
-    int_labels_map = {int(l): i for i, l in enumerate(labels)}
-    
-    batches = {
-        "phase1": [1, 2, 3, 4, 5],
-        "phase2": [5, 6, 7, 8, 9],
-        "phase3": [9, 10, 11],
-        "phase4": [11, 12, 13]
-    }
 
-    for name, run_numbers in batches.items():
-        batch_times = []
-        batch_labels = []
-        for run_num in run_numbers:
-            if run_num in int_labels_map:
-                index = int_labels_map[run_num]
-                batch_times.append(all_times[index])
-                # Adjust label by decrementing
-                batch_labels.append(f"{run_num - 1:02d}")
-        
-        if batch_times:
-            filename = f"boxplot_grid_{name}.png"
-            title = f"Benchmark Results ({name})"
-            create_custom_boxplot_grid(batch_times, batch_labels, filename, title)
+    for name, indices in batch_indices.items():
+        batch_stats = [all_stats[i] for i in indices]
+        batch_labels = [trend_labels[i] for i in indices]
+
+        filename = f"boxplot_grid_{name}.png"
+        if batch_stats and filename in stale_plots:
+            nrows = (len(batch_stats) + 2) // 3
+            create_boxplot_grid(batch_stats, batch_labels, nrows, 3, (12, 4 * nrows), filename)
+
+    # Record the inputs only once every stale plot has been drawn
+    for output_file in stale_plots:
+        record_inputs(output_file, manifests[output_file])
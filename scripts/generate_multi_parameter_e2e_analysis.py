@@ -7,27 +7,53 @@ import shlex
 import os
 from pathlib import Path
 
+try:
+    import orjson
+
+    def json_dumps(data) -> bytes:
+        return orjson.dumps(data, option=orjson.OPT_INDENT_2)
+
+    json_loads = orjson.loads
+except ImportError:
+    def json_dumps(data) -> bytes:
+        return json.dumps(data, indent=2).encode()
+
+    json_loads = json.loads
+
+def env_flag(name, default):
+    """Reads an on/off environment variable, rejecting values it does not recognise."""
+    value = os.environ.get(name, default).strip().lower()
+    if value in ("1", "true", "yes", "on"):
+        return True
+    if value in ("0", "false", "no", "off"):
+        return False
+    raise SystemExit(f"Error: {name} must be one of 1/true/yes/on or 0/false/no/off, got {value!r}.")
+
 # --- Configuration ---
 BENCH_BIN = "./target/release/parquet-nested-parallel"
 HYPERFINE_BIN = f"{Path.home()}/.cargo/bin/hyperfine"
 REPORTS_DIR = Path("reports")
+# Drop the page cache before every timed run. Set DROP_CACHES=0 to skip it.
+DROP_CACHES = env_flag("DROP_CACHES", "1")
 
 # Parameters to scan
 WRITER_LEVELS = [1, 2, 4, 6, 8]
 RECORD_LEVELS = [100000, 1000000, 10000000]
 BATCH_SIZE_LEVELS = [1024, 5120, 10240, 20480]
 
+# Custom metrics printed by the benchmark binary
+METRIC_PATTERNS = {
+    "total_time_ms": re.compile(r"Total generation and write time: ([\d.]+)ms"),
+    "record_throughput_m_sec": re.compile(r"Record Throughput: ([\d.]+)M records/sec"),
+    "mem_throughput_gb_sec": re.compile(r"In-Memory Throughput: ([\d.]+) GB/s"),
+}
+
 
 def parse_custom_metrics(output_text: str) -> dict:
     """Parses text to find custom metrics."""
     metrics = {}
-    patterns = {
-        "total_time_ms": r"Total generation and write time: ([\d.]+)ms",
-        "record_throughput_m_sec": r"Record Throughput: ([\d.]+)M records/sec",
-        "mem_throughput_gb_sec": r"In-Memory Throughput: ([\d.]+) GB/s",
-    }
-    for key, pattern in patterns.items():
-        match = re.search(pattern, output_text)
+    for key, pattern in METRIC_PATTERNS.items():
+        match = pattern.search(output_text)
         if match:
             try:
                 metrics[key] = float(match.group(1))
@@ -42,12 +68,12 @@ def inject_metrics_into_json(json_file: Path, metrics: dict):
         print("    -> No custom metrics found to inject.")
         return
     try:
-        with open(json_file, "r+") as f:
-            data = json.load(f)
+        with open(json_file, "rb+") as f:
+            data = json_loads(f.read())
             if data.get("results"):
                 data["results"][0]["custom_metrics"] = metrics
                 f.seek(0)
-                json.dump(data, f, indent=2)
+                f.write(json_dumps(data))
                 f.truncate()
                 print(f"    -> Injected custom metrics into {json_file.name}")
     except (FileNotFoundError, json.JSONDecodeError, PermissionError) as e:
@@ -76,6 +102,10 @@ def run_batch_scan():
         print("Warning: Could not determine original user ID. Files may remain owned by root.")
         user_id, group_id = None, None
 
+    prepare = "--prepare 'sync; echo 3 > /proc/sys/vm/drop_caches' " if DROP_CACHES else ""
+    if not DROP_CACHES:
+        print("DROP_CACHES is off: running without dropping the page cache between runs.")
+
     for i, (writers, records, batch_size) in enumerate(param_combinations):
         print(f"--- [{i+1}/{total_runs}] Benchmarking: {writers}w, {records}r, {batch_size}b ---")
         output_filename = REPORTS_DIR / f"run-W{writers}-R{records}-B{batch_size}.json"
@@ -84,29 +114,26 @@ def run_batch_scan():
         full_command_str = (
             f"RUST_LOG=info {shlex.quote(HYPERFINE_BIN)} "
             f"--warmup 1 --runs 10 "
-            f"--prepare 'sync; echo 3 > /proc/sys/vm/drop_caches' "
+            f"{prepare}"
             f"--show-output --export-json {shlex.quote(str(output_filename))} "
             f"{shlex.quote(bench_command)}"
         )
+        # The report file is created by root, so change its ownership back to the user
+        # in the same shell instead of spawning a separate `sudo chown`.
+        if user_id and group_id:
+            full_command_str += f" && chown {user_id}:{group_id} {shlex.quote(str(output_filename))}"
         command_to_run = ["sudo", "/bin/sh", "-c", full_command_str]
 
         try:
-            process = subprocess.Popen(command_to_run, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True, bufsize=1)
-            captured_output = [line for line in process.stdout]
+            # Capture the whole output in one read; stderr is merged to keep the interleaving
+            completed = subprocess.run(command_to_run, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True)
+            full_output_str = completed.stdout
 
-            return_code = process.wait()
-            if return_code != 0:
+            if completed.returncode != 0:
                 # Print the captured output before raising the error
-                print("".join(captured_output))
-                raise subprocess.CalledProcessError(return_code, command_to_run)
-
-            # --- KEY CHANGE: Fix file ownership ---
-            # The report file was created by root, so we change its ownership back to the user.
-            if user_id and group_id:
-                chown_command = ["sudo", "chown", f"{user_id}:{group_id}", str(output_filename)]
-                subprocess.run(chown_command, check=True)
+                print(full_output_str)
+                raise subprocess.CalledProcessError(completed.returncode, command_to_run)
 
-            full_output_str = "".join(captured_output)
             custom_metrics = parse_custom_metrics(full_output_str)
             inject_metrics_into_json(output_filename, custom_metrics)
 
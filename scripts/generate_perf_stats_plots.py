@@ -1,123 +1,202 @@
+import argparse
 import json
+import mmap
+import matplotlib
+matplotlib.use('Agg')
 import matplotlib.pyplot as plt
 import os
 import sys
-import subprocess
 import numpy as np
-import re
+import pandas as pd
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from output_manifest import record_inputs, run_label, stale_outputs
 
-def get_perf_data():
+try:
+    import orjson
+
+    def json_dumps(data) -> bytes:
+        return orjson.dumps(data, option=orjson.OPT_INDENT_2)
+
+    json_loads = orjson.loads
+except ImportError:
+    def json_dumps(data) -> bytes:
+        return json.dumps(data, indent=2).encode()
+
+    json_loads = json.loads
+
+plt.rcParams.update({
+    'path.simplify': True,
+    'path.simplify_threshold': 1.0,
+    'agg.path.chunksize': 10000,
+    'savefig.dpi': 100,
+})
+
+# Parsed stats are saved here, and reused on the next run for unchanged files.
+# Bump PARSER_VERSION whenever parse_perf_stat changes what it returns.
+PARSED_PERF_DATA_FILE = "parsed_perf_data.json"
+PARSER_VERSION = 2 # 2: insn_per_cycle is instructions / cycles, unrounded
+
+# Define the metrics to extract and their types
+METRICS_INFO = {
+    'cycles': int,
+    'instructions': int,
+    'cache-references': int,
+    'cache-misses': int,
+    'branch-instructions': int,
+    'branch-misses': int,
+    'time_elapsed': float, # Special case for 'seconds time elapsed'
+    'user_time': float, # Special case for 'seconds user'
+    'sys_time': float, # Special case for 'seconds sys'
+    'insn_per_cycle': float # Derived from instructions and cycles
+}
+
+# Metric lines of `perf stat` output look like "<count> <event> ..." or
+# "<seconds> seconds <kind> ...", so the token after the number names the metric
+COUNTER_METRICS = {name.encode(): name for name, metric_type in METRICS_INFO.items() if metric_type is int}
+SECONDS_METRICS = {b'time': 'time_elapsed', b'user': 'user_time', b'sys': 'sys_time'}
+
+# IPC has its own trend plot; the other nine metrics fill a fixed 3x3 grid
+PLOT_METRICS = [m for m in METRICS_INFO if m != 'insn_per_cycle']
+NROWS, NCOLS = 3, 3
+
+def record_metric(stats, metric_name, value):
+    """Stores the first value seen for a metric, cast to its type. Returns whether it was stored."""
+    if stats[metric_name] is not None:
+        return False
+    stats[metric_name] = METRICS_INFO[metric_name](value)
+    return True
+
+def parse_perf_stat(f):
+    """Parses a single perf_stat.txt file, returning its run label and metrics."""
+    stats = dict.fromkeys(METRICS_INFO) # Missing metrics stay None
+    label = run_label(f)
+
+    # An empty file cannot be mapped, and has nothing to parse anyway
+    if os.path.getsize(f) == 0:
+        return label, stats
+
+    # Split the mapped lines on whitespace and dispatch on the token after the number.
+    # Reading stops as soon as every parsed metric has a value.
+    remaining = len(COUNTER_METRICS) + len(SECONDS_METRICS)
+    with open(f, 'rb') as file, mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as content:
+        for line in iter(content.readline, b''):
+            parts = line.split()
+            if len(parts) < 2 or not parts[0][:1].isdigit():
+                continue
+
+            # Numbers in another locale's format (such as '1.234.567 cycles' or
+            # '1,23 seconds') are not recognised, so those metrics stay None
+            event = COUNTER_METRICS.get(parts[1].partition(b':')[0]) # Drop modifiers such as ':u'
+            if event:
+                count = parts[0].replace(b',', b'')
+                if count.isdigit():
+                    remaining -= record_metric(stats, event, count)
+            elif parts[1] == b'seconds' and len(parts) > 2 and parts[2] in SECONDS_METRICS:
+                if parts[0].replace(b'.', b'', 1).isdigit():
+                    remaining -= record_metric(stats, SECONDS_METRICS[parts[2]], parts[0])
+
+            if not remaining:
+                break
+
+    # The IPC that perf prints is instructions / cycles, so compute it unrounded
+    if stats['cycles'] and stats['instructions'] is not None:
+        stats['insn_per_cycle'] = stats['instructions'] / stats['cycles']
+
+    return label, stats
+
+def file_stat_key(f):
+    """Returns the (mtime_ns, size) pair used to tell whether a file changed."""
+    st = os.stat(f)
+    return st.st_mtime_ns, st.st_size
+
+def load_parsed_data(filename):
     """
-    Finds and reads all perf_stat.txt files, returning the parsed data.
+    Loads a previously saved parsed_perf_data.json as a cache, mapping each
+    source path to its (mtime_ns, size), run label and stats. Entries from
+    another parser version are left out, and a file that does not have the
+    expected shape gives an empty cache.
     """
     try:
-        fd_output = subprocess.check_output(['fd', 'perf_stat.txt', 'performance_results/'], text=True)
-        files = sorted(fd_output.strip().split('\n'))
-    except (subprocess.CalledProcessError, FileNotFoundError):
-        print("Error: Could not execute 'fd'. Please ensure 'fd' is installed and in your PATH.")
-        sys.exit(1)
+        output_data = json_loads(Path(filename).read_bytes())
+    except (FileNotFoundError, json.JSONDecodeError): # orjson's decode error subclasses json's
+        return {}
 
-    all_perf_stats = []
-    labels = []
-    
-    # Define the metrics to extract and their types
-    metrics_info = {
-        'cycles': int,
-        'instructions': int,
-        'cache-references': int,
-        'cache-misses': int,
-        'branch-instructions': int,
-        'branch-misses': int,
-        'time_elapsed': float, # Special case for 'seconds time elapsed'
-        'user_time': float, # Special case for 'seconds user'
-        'sys_time': float, # Special case for 'seconds sys'
-        'insn_per_cycle': float # New metric for IPC
-    }
+    cache = {}
+    try:
+        for run_data in output_data:
+            source = run_data['source']
+            if source['parser_version'] != PARSER_VERSION:
+                continue
+            stats = {metric_name: run_data[metric_name] for metric_name in METRICS_INFO}
+            cache[source['path']] = ((source['mtime_ns'], source['size']), run_data['run'], stats)
+    except (KeyError, TypeError): # Not a list of run entries, or an entry is incomplete
+        return {}
+    return cache
 
-    for f in files:
-        if not os.path.exists(f):
-            print(f"Warning: File not found, skipping: {f}")
-            continue
-        
-        stats = {}
-        with open(f, 'r') as file:
-            content = file.read()
-        
-        # Extract run label from filename
-        full_label = os.path.basename(os.path.dirname(f))
-        labels.append(full_label.split('-')[0])
-
-        # Parse each metric
-        for metric_name, metric_type in metrics_info.items():
-            if metric_name == 'time_elapsed':
-                match = re.search(r'^\s*([\d.]+)\s+seconds time elapsed', content, re.MULTILINE)
-            elif metric_name == 'user_time':
-                match = re.search(r'^\s*([\d.]+)\s+seconds user', content, re.MULTILINE)
-            elif metric_name == 'sys_time':
-                match = re.search(r'^\s*([\d.]+)\s+seconds sys', content, re.MULTILINE)
-            elif metric_name == 'insn_per_cycle':
-                match = re.search(r'#\s*([\d.]+)\s+insn per cycle', content)
-            else:
-                match = re.search(r'^\s*([\d,]+)\s+' + re.escape(metric_name), content, re.MULTILINE)
-            
-            if match:
-                value_str = match.group(1).replace(',', '')
-                stats[metric_name] = metric_type(value_str)
-            else:
-                stats[metric_name] = None # Or handle missing data as appropriate
-
-        all_perf_stats.append(stats)
-    
-    if not all_perf_stats:
-        print("Error: No perf stat data found to plot.")
-        sys.exit(1)
-        
-    return all_perf_stats, labels
+def get_perf_data(files, force=False):
+    """
+    Reads the perf_stat.txt files, returning the parsed data and whether it
+    differs from the saved parsed_perf_data.json. Files unchanged since that
+    was saved are not re-parsed, unless `force` is set.
+    """
+    cache = {} if force else load_parsed_data(PARSED_PERF_DATA_FILE)
+    stat_keys = {f: file_stat_key(f) for f in files}
+    stale = [f for f in files if f not in cache or cache[f][0] != stat_keys[f]]
+
+    # Threads overlap the file reads with parsing. The files are small enough that
+    # starting worker processes costs more than the parse itself.
+    # `map` keeps the results in the same order as `stale`.
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        parsed = dict(zip(stale, executor.map(parse_perf_stat, stale)))
+    print(f"Parsed {len(stale)} perf_stat.txt files, reused {len(files) - len(stale)} from {PARSED_PERF_DATA_FILE}")
 
-def print_parsed_data(all_perf_stats, labels):
-    """Saves the parsed performance statistics to a JSON file for review."""
+    results = [parsed[f] if f in parsed else cache[f][1:] for f in files]
+    all_perf_stats = [stats for _, stats in results]
+    labels = [label for label, _ in results]
+    sources = [
+        {"path": f, "mtime_ns": stat_keys[f][0], "size": stat_keys[f][1], "parser_version": PARSER_VERSION}
+        for f in files
+    ]
+    changed = bool(stale) or cache.keys() != set(files)
+
+    return all_perf_stats, labels, sources, changed
+
+def print_parsed_data(all_perf_stats, labels, sources):
+    """
+    Saves the parsed performance statistics to a JSON file for review. The
+    source file of each run is recorded so the next run can reuse the entry.
+    """
     output_data = []
     for i, stats in enumerate(all_perf_stats):
         run_data = {"run": labels[i]}
         run_data.update(stats)
+        run_data["source"] = sources[i]
         output_data.append(run_data)
     
-    output_filename = "parsed_perf_data.json"
-    with open(output_filename, 'w') as f:
-        json.dump(output_data, f, indent=4)
+    Path(PARSED_PERF_DATA_FILE).write_bytes(json_dumps(output_data))
     
-    print(f"\n--- Parsed Performance Data saved to {output_filename} ---\n")
+    print(f"\n--- Parsed Performance Data saved to {PARSED_PERF_DATA_FILE} ---\n")
 
 def create_perf_stat_plots(all_perf_stats, labels):
     """Generates a grid of line plots for perf stats."""
     
-    # Prepare data for plotting
-    metrics_to_plot = [m for m in all_perf_stats[0].keys() if m != 'insn_per_cycle']
+    # One column per metric; missing values become NaN and are dropped per plot
+    perf_df = pd.DataFrame(all_perf_stats)
+    perf_df['label'] = labels
     
-    # Filter out None values and transpose data for plotting
-    plot_data = {metric: [s[metric] for s in all_perf_stats if s.get(metric) is not None] for metric in metrics_to_plot}
-    
-    # Determine grid size
-    num_metrics = len(metrics_to_plot)
-    nrows = int(np.ceil(num_metrics / 3))
-    ncols = 3
-    
-    fig, axes = plt.subplots(nrows=nrows, ncols=ncols, figsize=(15, nrows * 5), sharex=False)
-
-    if nrows > 1 or ncols > 1:
-        axes = axes.flatten()
-    else:
-        axes = [axes]
+    fig, axes = plt.subplots(nrows=NROWS, ncols=NCOLS, figsize=(15, NROWS * 5), sharex=False, layout='constrained')
+    fig.get_layout_engine().set(rect=(0, 0.03, 1, 0.92))
+    axes = axes.flatten()
 
     line_props = {'marker':'o', 'color':'black'}
 
-    for i, metric in enumerate(metrics_to_plot):
+    for i, metric in enumerate(PLOT_METRICS):
         ax = axes[i]
         
-        valid_labels = [labels[j] for j, s in enumerate(all_perf_stats) if s.get(metric) is not None]
-
-        if plot_data[metric]:
-            ax.plot(valid_labels, plot_data[metric], **line_props)
+        values = perf_df[metric].dropna()
+        if not values.empty:
+            ax.plot(perf_df.loc[values.index, 'label'], values, **line_props)
         
         ax.set_title(metric.replace('_', ' ').title())
         ax.set_xlabel('Run Number')
@@ -125,11 +204,8 @@ def create_perf_stat_plots(all_perf_stats, labels):
         ax.spines['top'].set_visible(False)
         ax.spines['right'].set_visible(False)
 
-    for i in range(num_metrics, nrows * ncols):
-        fig.delaxes(axes[i])
-
-    plt.tight_layout(rect=[0, 0.03, 1, 0.95])
     plt.savefig("perf_stats.png")
+    plt.close()
     print("Generated perf_stats.png")
 
 def create_ipc_trend_plot(all_perf_stats, labels):
@@ -137,7 +213,7 @@ def create_ipc_trend_plot(all_perf_stats, labels):
     ipc_values = [s['insn_per_cycle'] for s in all_perf_stats if s.get('insn_per_cycle') is not None]
     valid_labels = [labels[i] for i, s in enumerate(all_perf_stats) if s.get('insn_per_cycle') is not None]
 
-    plt.figure(figsize=(10, 6))
+    plt.figure(figsize=(10, 6), layout='constrained')
     ax = plt.gca()
 
     plt.plot(valid_labels, ipc_values, marker='o', color='black')
@@ -149,36 +225,28 @@ def create_ipc_trend_plot(all_perf_stats, labels):
     ax.spines['top'].set_visible(False)
     ax.spines['right'].set_visible(False)
     
-    plt.tight_layout()
     plt.savefig("ipc_trend_plot.png")
+    plt.close()
     print("Generated ipc_trend_plot.png")
 
 def create_phased_perf_plots(perf_stats_batch, labels_batch, filename):
     """Generates a grid of line plots for a phase of perf stats."""
     
-    metrics_to_plot = [m for m in perf_stats_batch[0].keys() if m != 'insn_per_cycle']
-    plot_data = {metric: [s[metric] for s in perf_stats_batch if s.get(metric) is not None] for metric in metrics_to_plot}
-    
-    num_metrics = len(metrics_to_plot)
-    nrows = int(np.ceil(num_metrics / 3))
-    ncols = 3
+    perf_df = pd.DataFrame(perf_stats_batch)
+    perf_df['label'] = labels_batch
     
-    fig, axes = plt.subplots(nrows=nrows, ncols=ncols, figsize=(15, nrows * 5), sharex=False)
-    
-    if nrows > 1 or ncols > 1:
-        axes = axes.flatten()
-    else:
-        axes = [axes]
+    fig, axes = plt.subplots(nrows=NROWS, ncols=NCOLS, figsize=(15, NROWS * 5), sharex=False, layout='constrained')
+    fig.get_layout_engine().set(h_pad=0.2) # Extra room between rows for the titles
+    axes = axes.flatten()
 
     line_props = {'marker':'o', 'color':'black'}
 
-    for i, metric in enumerate(metrics_to_plot):
+    for i, metric in enumerate(PLOT_METRICS):
         ax = axes[i]
         
-        valid_labels = [labels_batch[j] for j, s in enumerate(perf_stats_batch) if s.get(metric) is not None]
-
-        if plot_data[metric]:
-            ax.plot(valid_labels, plot_data[metric], **line_props)
+        values = perf_df[metric].dropna()
+        if not values.empty:
+            ax.plot(perf_df.loc[values.index, 'label'], values, **line_props)
         
         ax.set_title(metric.replace('_', ' ').title())
         ax.set_xlabel('Run Number')
@@ -186,11 +254,8 @@ def create_phased_perf_plots(perf_stats_batch, labels_batch, filename):
         ax.spines['top'].set_visible(False)
         ax.spines['right'].set_visible(False)
 
-    for i in range(num_metrics, nrows * ncols):
-        fig.delaxes(axes[i])
-
-    plt.tight_layout(h_pad=3.0)
     plt.savefig(filename)
+    plt.close()
     print(f"Generated {filename}")
 
 def create_phased_ipc_trend_plot(perf_stats_batch, labels_batch, filename):
@@ -198,7 +263,7 @@ def create_phased_ipc_trend_plot(perf_stats_batch, labels_batch, filename):
     ipc_values = [s['insn_per_cycle'] for s in perf_stats_batch if s.get('insn_per_cycle') is not None]
     valid_labels = [labels_batch[i] for i, s in enumerate(perf_stats_batch) if s.get('insn_per_cycle') is not None]
     
-    plt.figure(figsize=(10, 6))
+    plt.figure(figsize=(10, 6), layout='constrained')
     ax = plt.gca()
 
     plt.plot(valid_labels, ipc_values, marker='o', color='black')
@@ -209,44 +274,71 @@ def create_phased_ipc_trend_plot(perf_stats_batch, labels_batch, filename):
     ax.spines['top'].set_visible(False)
     ax.spines['right'].set_visible(False)
     
-    plt.tight_layout()
     plt.savefig(filename)
+    plt.close()
     print(f"Generated {filename}")
 
 if __name__ == "__main__":
-    all_perf_stats, labels = get_perf_data()
-    print_parsed_data(all_perf_stats, labels)
-    create_perf_stat_plots(all_perf_stats, labels)
-    create_ipc_trend_plot(all_perf_stats, labels)
+    parser = argparse.ArgumentParser(description="Plots the perf stat results found under performance_results/.")
+    parser.add_argument('--force', action='store_true', help=f"re-parse every perf_stat.txt instead of reusing {PARSED_PERF_DATA_FILE}, and regenerate every plot")
+    args = parser.parse_args()
+
+    files = sorted(str(p) for p in Path('performance_results').rglob('perf_stat.txt'))
+    if not files:
+        print("Error: No perf stat data found to plot.")
+        sys.exit(1)
+    int_labels = np.array([int(run_label(f)) for f in files])
 
-    # --- Phased Perf Stats Plots ---
-    print("\nGenerating phased perf stats plots...")
-    
-    int_labels_map = {int(l): i for i, l in enumerate(labels)}
-    
     batches = {
         "phase1": [1, 2, 3, 4, 5],
         "phase2": [5, 6, 7, 8, 9],
         "phase3": [9, 10, 11],
         "phase4": [11, 12, 13]
     }
+    batch_indices = {name: np.flatnonzero(np.isin(int_labels, run_numbers)) for name, run_numbers in batches.items()}
+
+    # Each plot, with the result files it is drawn from
+    plot_files = {"perf_stats.png": files, "ipc_trend_plot.png": files}
+    for name, indices in batch_indices.items():
+        if len(indices):
+            plot_files[f"perf_stats_{name}.png"] = plot_files[f"ipc_trend_{name}.png"] = [files[i] for i in indices]
+    stale_plots, manifests = stale_outputs(plot_files, __file__, args.force)
+
+    if not stale_plots and os.path.exists(PARSED_PERF_DATA_FILE):
+        print("All perf stat plots are up to date.")
+        sys.exit(0)
+
+    all_perf_stats, labels, sources, changed = get_perf_data(files, force=args.force)
+    if changed:
+        print_parsed_data(all_perf_stats, labels, sources)
+
+    if "perf_stats.png" in stale_plots:
+        create_perf_stat_plots(all_perf_stats, labels)
+    if "ipc_trend_plot.png" in stale_plots:
+        create_ipc_trend_plot(all_perf_stats, labels)
+
+    # --- Phased Perf Stats Plots ---
+    print("\nGenerating phased perf stats plots...")
+
+    for name, indices in batch_indices.items():
+        batch_stats = [all_perf_stats[i] for i in indices]
 
-    for name, run_numbers in batches.items():
-        batch_stats = []
         batch_labels = []
-        for run_num in run_numbers:
-            if run_num in int_labels_map:
-                index = int_labels_map[run_num]
-                batch_stats.append(all_perf_stats[index])
-                
-                adjusted_label = f"{run_num - 1:02d}"
-                if adjusted_label == '00':
-                    adjusted_label += '\n(baseline)'
-                batch_labels.append(adjusted_label)
-        
+        for i in indices:
+            adjusted_label = f"{int_labels[i] - 1:02d}"
+            if adjusted_label == '00':
+                adjusted_label += '\n(baseline)'
+            batch_labels.append(adjusted_label)
+
         if batch_stats:
             filename_perf = f"perf_stats_{name}.png"
-            create_phased_perf_plots(batch_stats, batch_labels, filename_perf)
+            if filename_perf in stale_plots:
+                create_phased_perf_plots(batch_stats, batch_labels, filename_perf)
 
             filename_ipc = f"ipc_trend_{name}.png"
-            create_phased_ipc_trend_plot(batch_stats, batch_labels, filename_ipc)
+            if filename_ipc in stale_plots:
+                create_phased_ipc_trend_plot(batch_stats, batch_labels, filename_ipc)
+
+    # Record the inputs only once every stale plot has been drawn
+    for output_file in stale_plots:
+        record_inputs(output_file, manifests[output_file])
@@ -1,21 +1,76 @@
+import argparse
+import io
 import os
-import subprocess
-import shutil
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from output_manifest import record_inputs, run_label, stale_outputs
+import PIL
+from PIL import Image, ImageDraw, ImageFont
 
-def generate_phased_flamegraphs():
+try:
+    import cairosvg
+except (ImportError, OSError): # cairocffi raises OSError when libcairo itself is missing
+    cairosvg = None
+
+# The sized default font used as a fallback label font needs Pillow 10.1
+MIN_PILLOW_VERSION = (10, 1)
+MONTAGE_COLUMNS = 3
+FLAMEGRAPH_WIDTH, FLAMEGRAPH_HEIGHT = 1200, 800
+
+def load_annotation_font():
+    """Loads the bold label font, falling back to Pillow's built-in font."""
+    try:
+        return ImageFont.truetype('DejaVuSans-Bold.ttf', 40)
+    except OSError:
+        return ImageFont.load_default(size=40)
+
+def render_flamegraph(svg_file, annotation):
+    """Renders a flamegraph SVG to an image, with the run label in the top right corner."""
+    png_bytes = cairosvg.svg2png(url=svg_file, output_width=FLAMEGRAPH_WIDTH, background_color='black')
+    # Stretch to the exact tile size, as `-resize 1200x800!` did, whatever the SVG's height
+    with Image.open(io.BytesIO(png_bytes)) as rendered:
+        img = rendered.convert('RGB').resize((FLAMEGRAPH_WIDTH, FLAMEGRAPH_HEIGHT))
+
+    draw = ImageDraw.Draw(img)
+    draw.text(
+        (img.width - 20, 20), annotation, fill='#AAAAAA',
+        font=load_annotation_font(), anchor='ra', align='right'
+    )
+    return img
+
+def create_montage(images, output_file):
+    """
+    Tiles the images row by row into a grid of MONTAGE_COLUMNS columns, like
+    `montage -tile 3x -geometry +0+0`. Every tile is sized to the largest image.
+    """
+    tile_width = max(img.width for img in images)
+    tile_height = max(img.height for img in images)
+    ncols = min(len(images), MONTAGE_COLUMNS)
+    nrows = (len(images) + MONTAGE_COLUMNS - 1) // MONTAGE_COLUMNS
+
+    grid = Image.new('RGB', (ncols * tile_width, nrows * tile_height), 'white')
+    for i, img in enumerate(images):
+        row, col = divmod(i, MONTAGE_COLUMNS)
+        # Like montage, center an image that is smaller than its tile
+        x = col * tile_width + (tile_width - img.width) // 2
+        y = row * tile_height + (tile_height - img.height) // 2
+        grid.paste(img, (x, y))
+    grid.save(output_file)
+
+def generate_phased_flamegraphs(force=False):
+    """Builds one montage per phase, skipping montages whose SVGs are unchanged unless `force` is set."""
     print("--- Generating Phased Flamegraph Montages ---")
     
-    try:
-        fd_cmd = ['fd', '--extension', 'svg', '.', 'performance_results/']
-        result = subprocess.run(fd_cmd, capture_output=True, text=True, check=True)
-        all_svg_files = result.stdout.strip().split('\n')
-        if not all_svg_files or not all_svg_files[0]:
-            print("Error: No SVG files found in performance_results/. Exiting.")
-            return
-    except (subprocess.CalledProcessError, FileNotFoundError):
-        print("Error: Failed to find SVG files using 'fd'. Is 'fd' installed and in your PATH?")
+    all_svg_files = sorted(str(p) for p in Path('performance_results').rglob('*.svg'))
+    if not all_svg_files:
+        print("Error: No SVG files found in performance_results/. Exiting.")
         return
 
+    # Run directories are named '<run>-<date>-<commit>', so key each SVG by its run number
+    svg_by_run = {}
+    for f in all_svg_files:
+        svg_by_run.setdefault(run_label(f), f)
+
     phases = {
         "phase1": [1, 2, 3, 4, 5],
         "phase2": [5, 6, 7, 8, 9],
@@ -23,74 +78,75 @@ def generate_phased_flamegraphs():
         "phase4": [11, 12, 13]
     }
 
+    # Collect the runs of every phase up front. Phases overlap (runs 5, 9 and 11 end
+    # one phase and start the next), and a run's label does not depend on the phase,
+    # so each run is rendered only once.
+    phase_runs = {}
+
     for phase_name, run_numbers in phases.items():
-        print(f"➡️ Processing {phase_name}...")
-        
-        tmp_dir = f"tmp_flamegraphs_{phase_name}"
-        if os.path.exists(tmp_dir):
-            shutil.rmtree(tmp_dir)
-        os.makedirs(tmp_dir)
+        print(f"➡️ Preparing {phase_name}...")
 
-        png_files = []
+        phase_runs[phase_name] = []
         
-        for i, run_num in enumerate(run_numbers):
+        for run_num in run_numbers:
             run_num_padded = f"{run_num:02d}"
             
-            svg_file = None
-            for f in all_svg_files:
-                dir_name = os.path.basename(os.path.dirname(f))
-                if dir_name.startswith(f'{run_num_padded}-'):
-                    svg_file = f
-                    break
-            
+            svg_file = svg_by_run.get(run_num_padded)
             if not svg_file:
                 print(f"  -> Warning: SVG file for run {run_num_padded} not found. Skipping.")
                 continue
 
-            print(f"  -> Processing file for run {run_num_padded}: {os.path.basename(svg_file)}")
+            phase_runs[phase_name].append(run_num_padded)
+
+    # Leave out the phases whose montage is up to date
+    montage_files = {phase_name: f"flamegraph_montage_{phase_name}.png" for phase_name in phases}
+    plot_files = {montage_files[phase_name]: [svg_by_run[run] for run in runs] for phase_name, runs in phase_runs.items() if runs}
+    stale_montages, manifests = stale_outputs(plot_files, __file__, force)
+    phase_runs = {phase_name: runs for phase_name, runs in phase_runs.items() if not runs or montage_files[phase_name] in stale_montages}
+
+    annotations = {}
+    for runs in phase_runs.values():
+        for run_num_padded in runs:
+            if run_num_padded in annotations:
+                continue
+            print(f"  -> Queued file for run {run_num_padded}: {os.path.basename(svg_by_run[run_num_padded])}")
 
-            label_num = f"{run_num - 1:02d}"
+            label_num = f"{int(run_num_padded) - 1:02d}"
             annotation = label_num
             if label_num == "00":
                 annotation = f"{label_num}\n(baseline)"
+            annotations[run_num_padded] = annotation
 
-            output_filename = f"labeled_{i+1:02d}.png"
-            output_path = os.path.join(tmp_dir, output_filename)
-            png_files.append(output_path)
+    # cairosvg renders in-process, and Cairo's drawing calls release the GIL, so
+    # threads run the conversions in parallel. `map` keeps the order of `runs`.
+    runs = list(annotations)
+    print(f"➡️ Converting {len(runs)} SVG files...")
+    with ThreadPoolExecutor(max_workers=os.cpu_count()) as executor:
+        rendered = executor.map(lambda run: render_flamegraph(svg_by_run[run], annotations[run]), runs)
+        images_by_run = dict(zip(runs, rendered))
 
-            magick_cmd = [
-                'magick', svg_file,
-                '-density', '150', '-resize', '1200x800!', '-background', 'black',
-                '-fill', '#AAAAAA', '-pointsize', '40', '-weight', 'Bold',
-                '-gravity', 'NorthEast', '-annotate', f'+20+20', f'{annotation}',
-                output_path
-            ]
-            subprocess.run(magick_cmd, check=True, capture_output=True)
-
-        if not png_files:
+    for phase_name, phase_run_nums in phase_runs.items():
+        if not phase_run_nums:
             print(f"  -> No PNGs generated for {phase_name}. Skipping montage.")
-            shutil.rmtree(tmp_dir)
             continue
 
         print(f"  -> Assembling the grid for {phase_name}...")
-        montage_output_file = f"flamegraph_montage_{phase_name}.png"
-        
-        montage_cmd = [
-            'montage', *sorted(png_files),
-            '-tile', '3x', '-geometry', '+0+0',
-            montage_output_file
-        ]
-        subprocess.run(montage_cmd, check=True, capture_output=True)
-
-        print(f"  -> Cleaning up temporary files for {phase_name}...")
-        shutil.rmtree(tmp_dir)
+        montage_output_file = montage_files[phase_name]
+        create_montage([images_by_run[run] for run in phase_run_nums], montage_output_file)
+        record_inputs(montage_output_file, manifests[montage_output_file])
         
         print(f"✅ Done with {phase_name}! Final image is '{montage_output_file}'.")
 
 if __name__ == "__main__":
-    for cmd in ['fd', 'magick', 'montage']:
-        if not shutil.which(cmd):
-            print(f"Error: Required command '{cmd}' not found in PATH.")
-            exit(1)
-            
-    generate_phased_flamegraphs()
\ No newline at end of file
+    parser = argparse.ArgumentParser(description="Builds phased flamegraph montages from the SVGs under performance_results/.")
+    parser.add_argument('--force', action='store_true', help="rebuild every montage, even if its SVGs are unchanged")
+    args = parser.parse_args()
+
+    if cairosvg is None:
+        print("Error: Required module 'cairosvg' (and the Cairo library it uses) not found.")
+        exit(1)
+    if tuple(int(part) for part in PIL.__version__.split('.')[:2]) < MIN_PILLOW_VERSION:
+        print(f"Error: Pillow {'.'.join(map(str, MIN_PILLOW_VERSION))} or newer is required, found {PIL.__version__}.")
+        exit(1)
+
+    generate_phased_flamegraphs(force=args.force)
\ No newline at end of file
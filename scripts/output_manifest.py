@@ -0,0 +1,65 @@
+"""
+Records which inputs each generated plot was drawn from, so the plotting
+scripts can skip plots whose inputs and generating script are unchanged.
+"""
+import json
+import os
+
+MANIFEST_DIR = os.path.join('.cache', 'plot_inputs')
+
+def run_label(f):
+    """Returns the run label of a result file, from its '<run>-<date>-<commit>' directory."""
+    return os.path.basename(os.path.dirname(f)).split('-')[0]
+
+def file_manifest(files):
+    """Returns the [path, mtime_ns, size] of every file, sorted by path."""
+    manifest = []
+    for f in sorted(str(f) for f in files):
+        st = os.stat(f)
+        manifest.append([f, st.st_mtime_ns, st.st_size])
+    return manifest
+
+def input_manifest(input_files, script):
+    """Returns the manifest of a plot's input files together with the script that draws it."""
+    return file_manifest([*input_files, os.path.abspath(script)])
+
+def manifest_file(output_file):
+    """Returns where the inputs of `output_file` are recorded."""
+    name = os.path.normpath(output_file).replace(os.sep, '%')
+    return os.path.join(MANIFEST_DIR, f"{name}.json")
+
+def needs_rebuild(output_file, manifest, force=False):
+    """
+    Returns whether `output_file` has to be drawn again: it is missing, it changed
+    since it was drawn, or it was drawn from other inputs (added, removed or
+    modified files, or another version of the script). Prints a note when it is skipped.
+    """
+    if not force and os.path.exists(output_file):
+        try:
+            with open(manifest_file(output_file)) as f:
+                recorded = json.load(f)
+        except (FileNotFoundError, ValueError):
+            recorded = None
+        if recorded == {"inputs": manifest, "output": file_manifest([output_file])}:
+            print(f"Skipping {output_file}: up to date")
+            return False
+    return True
+
+def stale_outputs(plot_files, script, force=False):
+    """
+    Takes a mapping of each output file to the input files it is drawn from by
+    `script`. Returns the outputs that have to be drawn again, and the manifest
+    of every output to record with `record_inputs` once it is drawn. Only the
+    files are stat'ed, so this is cheap enough to run before loading any data.
+    """
+    manifests = {output_file: input_manifest(inputs, script) for output_file, inputs in plot_files.items()}
+    stale = {output_file for output_file, manifest in manifests.items() if needs_rebuild(output_file, manifest, force)}
+    return stale, manifests
+
+def record_inputs(output_file, manifest):
+    """Records the inputs `output_file` was just drawn from."""
+    os.makedirs(MANIFEST_DIR, exist_ok=True)
+    path = manifest_file(output_file)
+    with open(path + '.tmp', 'w') as f:
+        json.dump({"inputs": manifest, "output": file_manifest([output_file])}, f)
+    os.replace(path + '.tmp', path)